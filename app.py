@@ -1,13 +1,17 @@
 import streamlit as st  # type: ignore
 import soundfile as sf  # type: ignore
 import numpy as np  # type: ignore
+from scipy.fft import rfft, rfftfreq, next_fast_len  # type: ignore
+from numba import njit, prange  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import os
+import functools
+import io
+import math
 import re
-import json
-import hashlib
+import orjson  # type: ignore
+import xxhash  # type: ignore
 from pathlib import Path
-import tempfile
 
 # ========== PATHS ==========
 APP_ROOT = Path(__file__).parent.resolve()
@@ -16,91 +20,268 @@ UPLOADS_DIR = APP_ROOT / "uploads"
 USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
 UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
 
-JSON_PATH = USER_DATA_DIR / "all_feedbacks.json"
+JSON_PATH = USER_DATA_DIR / "all_feedbacks.json"  # פורמט ישן — מומר בקריאה הראשונה
+JSONL_PATH = USER_DATA_DIR / "all_feedbacks.jsonl"
+COUNTERS_PATH = USER_DATA_DIR / "project_counters.json"
 
 # ========== HELPERS ==========
 
+# דפוסים מקומפלים פעם אחת — נקראים בכל rerun של Streamlit
+_EMAIL_RE = re.compile(r"^[\w\.-]+@[\w\.-]+\.\w+$")
+_UNSAFE_CHARS_RE = re.compile(r'[^a-zA-Z0-9_\-\.]')
+_PROJECT_NUM_RE = re.compile(r'__project_(\d+)\.')
+
 def is_valid_email(email: str) -> bool:
-    pattern = r"^[\w\.-]+@[\w\.-]+\.\w+$"
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 def safe_filename(s: str) -> str:
-    s = re.sub(r'[^a-zA-Z0-9_\-\.]', '_', s)
+    s = _UNSAFE_CHARS_RE.sub('_', s)
     return s[:64]
 
+def _record_key(rec: dict) -> tuple:
+    return (rec.get("email"), rec.get("file_hash"))
+
+@st.cache_data(show_spinner=False, max_entries=2)
+def _parse_records(mtime_ns: int) -> dict:
+    """מקפל את קובץ השורות למילון לפי (email+file_hash) — השורה האחרונה קובעת.
+
+    ממופתח לפי mtime של הקובץ, כך שכתיבה מפקיעה את המטמון אוטומטית
+    וכל rerun של Streamlit לא מפענח את הקובץ מחדש.
+    """
+    merged: dict = {}
+    try:
+        with JSONL_PATH.open('rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = orjson.loads(line)
+                except Exception:
+                    continue
+                if isinstance(rec, dict):
+                    merged[_record_key(rec)] = rec
+    except Exception:
+        pass
+    return merged
+
+def _records_by_key() -> dict:
+    if not JSONL_PATH.exists() and JSON_PATH.exists():
+        _migrate_legacy_store()
+    if not JSONL_PATH.exists():
+        return {}
+    return _parse_records(JSONL_PATH.stat().st_mtime_ns)
+
 def _load_records() -> list:
-    if JSON_PATH.exists() and JSON_PATH.stat().st_size > 0:
-        try:
-            with JSON_PATH.open('r', encoding='utf-8') as f:
-                data = json.load(f)
-            if isinstance(data, list):
-                return data
-        except Exception:
-            pass
-    return []
+    return list(_records_by_key().values())
+
+def _append_record(record: dict) -> None:
+    """כתיבה ב-O(1) — שורה אחת בסוף הקובץ במקום שכתוב של כל ההיסטוריה."""
+    with JSONL_PATH.open('ab') as f:
+        f.write(orjson.dumps(record) + b'\n')
 
 def _write_records(data: list) -> None:
-    with JSON_PATH.open('w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-def compute_file_hash(file_path: Path) -> str:
-    """SHA1 קצר עבור זיהוי תוכן (10 תווים)"""
-    h = hashlib.sha1()
-    with open(file_path, 'rb') as f:
-        while True:
-            chunk = f.read(8192)
-            if not chunk:
-                break
-            h.update(chunk)
-    return h.hexdigest()[:10]
-
-def find_record_index(email: str, file_hash: str) -> int | None:
-    data = _load_records()
-    for i, rec in enumerate(data):
-        if rec.get("email") == email and rec.get("file_hash") == file_hash:
-            return i
-    return None
+    """שכתוב מלא — רק עבור דחיסה (compaction) או המרה מהפורמט הישן."""
+    with JSONL_PATH.open('wb') as f:
+        for rec in data:
+            f.write(orjson.dumps(rec) + b'\n')
+
+def _strip_timestamps(rec: dict) -> dict:
+    return {k: v for k, v in rec.items() if k not in ("created_at", "updated_at")}
+
+def _maybe_compact() -> None:
+    """דוחס את קובץ השורות כשמספר השורות עולה בהרבה על מספר הרשומות הייחודיות."""
+    try:
+        with JSONL_PATH.open('rb') as f:
+            n_lines = sum(1 for _ in f)
+    except OSError:
+        return
+    records = _load_records()
+    if n_lines > max(64, 4 * len(records)):
+        _write_records(records)
+
+def _migrate_legacy_store() -> None:
+    try:
+        data = orjson.loads(JSON_PATH.read_bytes())
+        if isinstance(data, list):
+            _write_records(data)
+    except Exception:
+        pass
+
+def content_hash(buf) -> str:
+    """xxh3 קצר עבור זיהוי תוכן (10 תווים) — לא קריפטוגרפי, רק מזהה"""
+    return xxhash.xxh3_64(buf).hexdigest()[:10]
+
+def find_record(email: str, file_hash: str) -> dict | None:
+    return _records_by_key().get((email, file_hash))
+
+def _load_counters() -> dict:
+    try:
+        data = orjson.loads(COUNTERS_PATH.read_bytes())
+        if isinstance(data, dict):
+            return data
+    except Exception:
+        pass
+    return {}
+
+def _save_counters(counters: dict) -> None:
+    COUNTERS_PATH.write_bytes(orjson.dumps(counters))
 
 def get_next_project_number(email: str) -> int:
-    """מספר הפרויקט הבא עבור משתמש לפי מה ששמור ב-JSON."""
-    data = _load_records()
-    max_n = 0
-    for rec in data:
-        if rec.get("email") == email:
-            fname = rec.get("filename", "")
-            m = re.search(r'__project_(\d+)\.', fname)
-            if m:
-                n = int(m.group(1))
-                if n > max_n:
-                    max_n = n
-    return max_n + 1
+    """מספר הפרויקט הבא עבור משתמש — מונה O(1) במקום סריקת regex על כל הרשומות."""
+    counters = _load_counters()
+    if email not in counters:
+        # אתחול חד-פעמי ממשתמשים שקיימים מלפני קובץ המונים
+        max_n = 0
+        for rec in _load_records():
+            if rec.get("email") == email:
+                m = _PROJECT_NUM_RE.search(rec.get("filename", ""))
+                if m:
+                    max_n = max(max_n, int(m.group(1)))
+        counters[email] = max_n
+    n = int(counters[email]) + 1
+    counters[email] = n
+    _save_counters(counters)
+    return n
 
 def build_project_filename(email: str, project_num: int, ext: str) -> Path:
     email_part = safe_filename(email.split("@")[0]) if email else "anon"
     return UPLOADS_DIR / f"{email_part}__project_{project_num}{ext}"
 
 def save_or_update_record(email: str, record: dict) -> None:
-    """מעדכן רשומה קיימת לפי (email + file_hash) או יוצר חדשה אם אין."""
-    data = _load_records()
-    idx = None
-    fh = record.get("file_hash")
-    if fh:
-        for i, rec in enumerate(data):
-            if rec.get("email") == email and rec.get("file_hash") == fh:
-                idx = i
-                break
+    """מוסיף שורה ממוזגת לפי (email + file_hash); הקיפול בקריאה שומר על רשומה אחת למפתח."""
+    existing = _records_by_key().get((email, record.get("file_hash")))
 
     now_iso = datetime.now().isoformat()
-    if idx is None:
+    if existing is None:
+        record = dict(record)
         record["created_at"] = now_iso
-        record["updated_at"] = now_iso
-        data.append(record)
     else:
-        # עדכון במקום—לא יוצרים רשומה כפולה
-        data[idx].update(record)
-        data[idx]["updated_at"] = now_iso
-
-    _write_records(data)
+        # ממזגים על הרשומה הקיימת—לא יוצרים רשומה כפולה
+        merged = dict(existing)
+        merged.update(record)
+        if _strip_timestamps(merged) == _strip_timestamps(existing):
+            # כל rerun של Streamlit מגיע לכאן — בלי שינוי אמיתי אין מה להוסיף שורה
+            return
+        record = merged
+    record["updated_at"] = now_iso
+
+    _append_record(record)
+    _maybe_compact()
+
+# ========== AUDIO ANALYSIS ==========
+
+# פריימים קצרים עם חפיפה של 50% — הרבה FFT קטנים שנכנסים ל-cache
+# במקום FFT אחד ענק על כל הקובץ
+FRAME_SIZE = 8192
+HOP_SIZE = 4096
+BLOCK_SIZE = 65536  # דגימות לבלוק פענוח — RAM קבוע גם לקבצים של שעה
+# אורך ה-FFT בפועל — מבטיח גודל ידידותי לרדיקסים גם אם FRAME_SIZE יכוון לערך לא-חלק
+NFFT = next_fast_len(FRAME_SIZE, real=True)
+
+@functools.lru_cache(maxsize=None)
+def _hann_window(n: int):
+    return np.hanning(n).astype(np.float32)
+
+@functools.lru_cache(maxsize=None)
+def _rfft_freqs(n: int, samplerate: int):
+    return rfftfreq(n, 1 / samplerate).astype(np.float32)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _sample_stats(x):
+    """סכום ריבועים ו-peak במעבר יחיד על הדגימות, בלי מערכי ביניים בגודל הקובץ."""
+    sq_sum = 0.0
+    peak = 0.0
+    for i in prange(x.size):
+        v = x[i]
+        sq_sum += v * v
+        peak = max(peak, abs(v))
+    return sq_sum, peak
+
+@njit(fastmath=True, cache=True)
+def _spectral_stats(freqs, spectrum):
+    """centroid ו-argmax במעבר יחיד על חצי-הספקטרום (4097 בינים)."""
+    weighted = 0.0
+    total = 0.0
+    best = 0
+    for i in range(spectrum.size):
+        s = spectrum[i]
+        weighted += freqs[i] * s
+        total += s
+        if s > spectrum[best]:
+            best = i
+    return weighted / (total + 1e-12), best
+
+def averaged_spectrum(data_arr, samplerate):
+    """ספקטרום הספק מצטבר על פריימים חלוניים (בסגנון Welch) עבור centroid/dominant_freq."""
+    if len(data_arr) < FRAME_SIZE:
+        padded = np.zeros(FRAME_SIZE, dtype=data_arr.dtype)
+        padded[:len(data_arr)] = data_arr
+        data_arr = padded
+    frames = np.lib.stride_tricks.sliding_window_view(data_arr, FRAME_SIZE)[::HOP_SIZE]
+    S = rfft(frames * _hann_window(FRAME_SIZE), n=NFFT, axis=1, workers=-1)
+    # הספק (re²+im²) ישירות לבין — בלי ה-sqrt של np.abs ובלי טמפ בגודל (פריימים, בינים)
+    spectrum = np.einsum('fb,fb->b', S.real, S.real) + np.einsum('fb,fb->b', S.imag, S.imag)
+    freqs = _rfft_freqs(NFFT, samplerate)
+    return spectrum, freqs
+
+# המפתחות שהאנליזה מפיקה; רשומה שמכילה את כולם לא צריכה ניתוח מחדש
+FEATURE_KEYS = ('duration', 'lufs', 'peak', 'crest_factor', 'centroid', 'dominant_freq')
+
+@st.cache_data(show_spinner=False)
+def analyze_audio(file_hash: str, _src):
+    """אנליזה בזרימה בלוק-אחרי-בלוק — זיכרון O(BLOCK_SIZE) במקום כל הקובץ ב-RAM.
+
+    _src הוא נתיב או אובייקט קובץ בזיכרון (כמו ה-buffer של Streamlit), כך
+    שהאנליזה לא תלויה בכתיבה לדיסק. המטמון ממופתח לפי file_hash בלבד
+    (המקור מתחיל ב-_ ולכן לא נכנס למפתח).
+    """
+    src = _src if hasattr(_src, 'read') else str(_src)
+    if hasattr(src, 'seek'):
+        src.seek(0)
+    samplerate = sf.info(src).samplerate
+    if hasattr(src, 'seek'):
+        src.seek(0)
+    sq_sum = 0.0
+    peak = 0.0
+    n_samples = 0
+    spectrum = np.zeros(NFFT // 2 + 1, dtype=np.float32)
+    freqs = _rfft_freqs(NFFT, samplerate)
+    mono_buf = np.empty(BLOCK_SIZE, dtype=np.float32)  # ממוחזר בין בלוקים — בלי הקצאה פר-בלוק
+    for block in sf.blocks(src, blocksize=BLOCK_SIZE, dtype='float32', always_2d=True):
+        if block.shape[1] == 1:
+            mono = block[:, 0]
+        elif block.shape[1] == 2:
+            mono = mono_buf[:block.shape[0]]
+            np.add(block[:, 0], block[:, 1], out=mono)
+            mono *= 0.5
+        else:
+            mono = block.mean(axis=1, dtype=np.float32)
+        block_sq, block_peak = _sample_stats(mono)
+        sq_sum += float(block_sq)
+        peak = max(peak, float(block_peak))
+        n_samples += mono.size
+        block_spec, _ = averaged_spectrum(mono, samplerate)
+        spectrum += block_spec
+    rms = math.sqrt(sq_sum / max(n_samples, 1))
+    # שורש על 4097 בינים בלבד: מחזיר משקול מגניטודה ל-centroid — משקול הספק
+    # קורס לתדרים הנמוכים באודיו אמיתי והופך את סיווגי ה-tips. ה-argmax אדיש לשורש.
+    spectrum = np.sqrt(spectrum)
+    centroid, dominant_idx = _spectral_stats(freqs, spectrum)
+    return {
+        'duration': n_samples / samplerate,
+        'lufs': float(20 * math.log10(rms + 1e-12)),
+        'peak': peak,
+        'crest_factor': float(peak / (rms + 1e-12)),
+        'centroid': float(centroid),
+        'dominant_freq': float(freqs[dominant_idx]),
+    }
+
+def _analysis_executor() -> ThreadPoolExecutor:
+    """Executor אחד לסשן — soundfile וה-FFT משחררים את ה-GIL, אז האנליזה רצה במקביל ל-UI."""
+    if '_executor' not in st.session_state:
+        st.session_state['_executor'] = ThreadPoolExecutor(max_workers=2)
+    return st.session_state['_executor']
 
 # ========== PROFESSIONAL TIPS ==========
 def professional_tips(lufs, peak, crest, centroid, dominant_freq):
@@ -213,19 +394,17 @@ if uploaded_file:
 
         email = st.session_state.get('user_email', 'anon')
         ext = Path(uploaded_file.name).suffix.lower()
-        tmp = UPLOADS_DIR / f"__tmp{ext}"
-        with open(tmp, "wb") as f:
-            f.write(uploaded_file.read())
-
-        file_hash = compute_file_hash(tmp)
+        # memoryview על הבאפר הפנימי של Streamlit — בלי העתק bytes של כל הקובץ,
+        # ואותו buffer משמש ל-hash, לאנליזה ולכתיבה
+        buf = uploaded_file.getbuffer()
+        file_hash = content_hash(buf)
 
         # האם יש כבר רשומה עבור אותו תוכן?
-        idx = find_record_index(email, file_hash)
-        data = _load_records()
+        prior = find_record(email, file_hash)
 
-        if idx is not None:
+        if prior is not None:
             # יש רשומה קודמת – משתמשים באותו שם קובץ, מחליפים תוכן
-            existing_filename = data[idx].get("filename")
+            existing_filename = prior.get("filename")
             if existing_filename:
                 final_path = UPLOADS_DIR / existing_filename
             else:
@@ -237,22 +416,23 @@ if uploaded_file:
             n = get_next_project_number(email)
             final_path = build_project_filename(email, n, ext)
 
-        # מחליפים/יוצרים את הקובץ הסופי בלי שכפולים
-        os.replace(tmp, final_path)
-
-        # ניתוח
-        data_arr, samplerate = sf.read(final_path)
-        if data_arr.ndim > 1:
-            data_arr = np.mean(data_arr, axis=1)
-        duration = len(data_arr) / samplerate
-        rms = float(np.sqrt(np.mean(data_arr**2)))
-        peak = float(np.max(np.abs(data_arr)))
-        crest_factor = float(peak / (rms + 1e-12))
-        lufs = float(20 * np.log10(rms + 1e-12))
-        spectrum = np.abs(np.fft.rfft(data_arr))
-        freqs = np.fft.rfftfreq(len(data_arr), 1/samplerate)
-        centroid = float(np.sum(freqs * spectrum) / (np.sum(spectrum) + 1e-12))
-        dominant_freq = float(freqs[np.argmax(spectrum)])
+        # הכתיבה לדיסק היא לצורך שימור בלבד — רצה ברקע, מחוץ לנתיב הקריטי
+        persist_fut = _analysis_executor().submit(final_path.write_bytes, buf)
+
+        # ניתוח — תוכן שכבר נותח עבור המשתמש לא עובר FFT מחדש
+        if prior is not None and all(k in prior for k in FEATURE_KEYS):
+            features = {k: prior[k] for k in FEATURE_KEYS}
+        else:
+            # מנתחים ישירות מהזיכרון — בלי לחכות לכתיבה ובלי קריאה חוזרת מהדיסק
+            fut = _analysis_executor().submit(analyze_audio, file_hash, io.BytesIO(buf))
+            with st.spinner("Analyzing audio..."):
+                features = fut.result()
+        duration = features['duration']
+        lufs = features['lufs']
+        peak = features['peak']
+        crest_factor = features['crest_factor']
+        centroid = features['centroid']
+        dominant_freq = features['dominant_freq']
 
         # מציגים רק את התוכן החשוב (ללא הודעת "File loaded successfully")
         main_tip, tips, explanation = professional_tips(lufs, peak, crest_factor, centroid, dominant_freq)
@@ -305,6 +485,8 @@ Project Stage: {project_stage}<br>
             'genre': genre,
             'project_stage': project_stage,
         }
+        # מוודאים שהכתיבה ברקע הסתיימה (ומעלים שגיאה אם נכשלה) לפני תיעוד שם הקובץ
+        persist_fut.result()
         save_or_update_record(email, record)
 
         # נחזיק מזהים בסשן כדי ש-"Submit feedback" יעדכן את אותה רשומה